@@ -3,8 +3,8 @@ import pytest
 import inspect
 
 from xtend import (
-    strip, xtend, scan, parse, XtendParseException, Node, StrNode, IfNode, ExprNode,
-    ForNode)
+    strip, xtend, scan, parse, compile_template, XtendParseException, Node, StrNode,
+    IfNode, ExprNode, ForNode)
 
 
 @pytest.mark.parametrize('input, output', [
@@ -15,10 +15,12 @@ from xtend import (
         'string, keyword, code, string, keyword, string', id='if'),
     pytest.param(
         '    {FOR item IN list}\n',
-        'indent, keyword, code, keyword, code, newline',
+        'string, keyword, code, keyword, code, string',
         id='with-white-space'
     ),
     pytest.param('1{{2}}3', 'string', id='escape'),
+    pytest.param('{IF(c)}{ENDING}{END}', 'keyword, code, code, keyword', id='keyword-boundaries'),
+    pytest.param('{IFé}{éIF}{IF}', 'code, code, keyword', id='keyword-boundaries-unicode'),
     pytest.param('inbalanced { inbalanced', None, id='inbalanced')
 ])
 def test_scanner(input: str, output: str):
@@ -43,7 +45,10 @@ def test_scanner(input: str, output: str):
     pytest.param('{IF c}s{ELSE}s', None, id='if-no-end'),
     pytest.param('{IF c}{END}', None, id='if-no-stmt'),
     pytest.param('{IF }s{END}', None, id='if-no-code'),
+    pytest.param('{IF c +}s{END}', None, id='if-invalid-code'),
     pytest.param('{IF c}', None, id='if-no-follow'),
+    pytest.param('{IF c}s', None, id='if-no-tail'),
+    pytest.param('{IN}', None, id='keyword-no-stmt'),
     pytest.param('{IF c}{c}s{END}', [IfNode], id='if-stmts'),
     pytest.param('{END}', None, id='end-no-if'),
     pytest.param('s{END}', None, id='str-end-no-if'),
@@ -52,6 +57,8 @@ def test_scanner(input: str, output: str):
     pytest.param('{IF c}s{ELSE}{END}', None, id='else-no-stmt'),
     pytest.param('{FOR item IN list}{item}{END}', [ForNode], id='for'),
     pytest.param('something { inbalanced', None, id='inbalanced-tmpl'),
+    pytest.param('{IF c}' * 200 + 's' + '{END}' * 200, [IfNode], id='nested'),
+    pytest.param('{IF c}' * 201 + 's' + '{END}' * 201, None, id='nested-too-deep'),
     pytest.param('''
         {IF c}
             s
@@ -68,6 +75,10 @@ def test_parser(input: str, output: List[Node]):
     assert result_output == output
 
 
+def test_parse_cache():
+    assert parse('class {name}:') is parse('class {name}:')
+
+
 def test_parse_exception():
     try:
         parse('\n{IF c}\ns{ELIF}\n{END}')
@@ -78,6 +89,18 @@ def test_parse_exception():
     assert False, 'expected a parse exception'
 
 
+@pytest.mark.parametrize('input, expected', [
+    pytest.param('abc\n{IN}', "['string', 'code', 'IF', 'FOR']", id='top-level'),
+    pytest.param('{IF c}s{IN}', "['string', 'code', 'IF', 'FOR', 'ELIF', 'ELSE', 'END']", id='if'),
+    pytest.param('{IF c}s{ELSE}s{IN}', "['string', 'code', 'IF', 'FOR', 'END']", id='else'),
+    pytest.param('{FOR c IN l}s{IN}', "['string', 'code', 'IF', 'FOR', 'END']", id='for'),
+])
+def test_parse_exception_expected(input: str, expected: str):
+    with pytest.raises(XtendParseException) as e:
+        parse(input)
+    assert str(e.value).startswith(f'Expected {expected}, got IN')
+
+
 def test_python():
     global global_var
     global_var = 'global'
@@ -92,7 +115,7 @@ def test_python():
     called()
 
 
-@pytest.mark.parametrize('input, context, output', [
+xtend_params = [
     pytest.param('s', {}, 's', id='string'),
     pytest.param('{v}', {'v': 'value'}, 'value', id='expr'),
     pytest.param('{IF c}t{ELSE}f{END}', {'c': True}, 't', id='if'),
@@ -115,7 +138,10 @@ def test_python():
             __init__(self):
                 pass
     '''), id='indent'),
-])
+]
+
+
+@pytest.mark.parametrize('input, context, output', xtend_params)
 def test_xtend(input: str, context: dict, output: str):
     locals().update(context)
     result_output = xtend(input)
@@ -129,3 +155,16 @@ def test_xtend(input: str, context: dict, output: str):
         print('---')
 
     assert output == xtend(input)
+
+
+@pytest.mark.parametrize('input, context, output', xtend_params)
+def test_compile_template_run(input: str, context: dict, output: str):
+    # the compiled template and the fallback node.run have to render the same output
+    assert compile_template(input)({}, context) == parse(input).run({}, context)
+
+
+def test_compile_template_nested():
+    level = '{FOR c IN l SEPARATOR ","}{IF c == "a"}x{ELIF c == "b"}y{ELSE}'
+    input = level * 25 + '{c}' + '{END}{END}' * 25
+    assert compile_template(input) == parse(input).run
+    assert compile_template(input)({}, {'l': ['a', 'b', 'c']}) == 'x,y,' * 25 + 'c'
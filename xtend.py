@@ -1,106 +1,169 @@
-from typing import Tuple, Union, List, Optional, NoReturn
+from typing import Tuple, Union, List, Optional, NoReturn, Callable, Dict, Any, ClassVar
+from types import CodeType
 from dataclasses import dataclass
-import re
+import functools
 import inspect
+import re
+import sys
 
 
 def strip(str) -> str:
     return inspect.cleandoc(str)
 
 
+# Token types are interned, so that they can be compared by identity.
+T_STRING, T_CODE, T_KEYWORD = map(sys.intern, ('string', 'code', 'keyword'))
+
+KEYWORDS = frozenset(('IF', 'ELSE', 'ELIF', 'FOR', 'IN', 'END', 'SEPARATOR'))
+# keywords are upper case words, candidates are checked against KEYWORDS
+word_pattern = re.compile(r'\b[A-Z]+\b')
+_find_words = word_pattern.finditer
+
+
 class Scanner:
-    tokens = {
-        'keyword': r'IF|ELSE|ELIF|FOR|IN|END|SEPARATOR',
-        'open': r'(?<!{){(?!{)',
-        'close': r'(?<!})}(?!})',
-        'newline': r'\n',
-        'indent': r'    |\t',
-        'other': r'.'
-    }
-
-    token_pattern = re.compile('|'.join([
-        f'(?P<{name}>{expr})' for name, expr in tokens.items()
-    ]))
+    '''
+    Splits the input into tokens. The scanner always holds the current token in
+    token and value (both None at the end of the input); advance moves to the next one.
+    '''
+    __slots__ = (
+        'input', 'state', 'position', 'token', 'value', '_start', '_stop', '_brace',
+        '_keywords', '_open', '_close', '_advance_state')
 
     state_string = 'string'
     state_xtend = 'xtend'
 
-    def __init__(self, input):
+    def __init__(self, input: str):
         self.input = input
-        self.stream = self.token_pattern.finditer(input)
-        self._lookahead = None
-        self.state = 'string'
+        self.state = self.state_string
         self.position = 0, 0
+        self.token: str = None
+        self.value: str = None
+        self._start = 0
+        self._stop = 0
+        self._brace = -1
+        self._keywords: List[Tuple[int, int, str]] = []
+        self._open = input.find('{')
+        self._close = input.find('}')
+        self._advance_state = self._advance_string
+        self._segment(0)
+        self.advance()
+
+    def _segment(self, start: int) -> None:
+        # the current segment of string or code spans from start to the next single brace
+        self._start = start
+        self._brace = self._find_brace(start)
+        self._stop = len(self.input) if self._brace == -1 else self._brace
+
+    def _find_brace(self, start: int) -> int:
+        '''
+        Returns the index of the next single brace at or after start, or -1. Runs of
+        two or more braces (e.g. {{ or }}) are escapes and belong to the surrounding
+        text. The next positions of both brace kinds are kept between calls, so that
+        each part of the input is searched only once for each kind.
+        '''
+        input = self.input
+        open_index, close_index = self._open, self._close
+        if -1 < open_index < start:
+            open_index = input.find('{', start)
+        if -1 < close_index < start:
+            close_index = input.find('}', start)
 
-    def _next(self) -> Tuple[str, str]:
-        if self._lookahead:
-            next_item = self._lookahead
-            self._lookahead = None
-            return next_item
-        match = next(self.stream, None)
-        if match:
-            self.position = match.span()
-            return match.lastgroup, match.group()
-        return None, None
-
-    def _peek(self) -> Tuple[str, str]:
-        if not self._lookahead:
-            self._lookahead = self._next()
-        return self._lookahead
-
-    def next(self) -> Tuple[str, str]:
-        token, value = self._next()
-        if self.state == self.state_string:
-            if token in ['other', 'keyword']:
-                values = [value]
-                while self._peek()[0] in ['other', 'keyword']:
-                    _, value = self._next()
-                    values.append(value)
-                return 'string', ''.join(values)
-
-            if token in ['newline', 'indent']:
-                return (token, value)
-
-            if token == 'open':
+        while True:
+            if close_index == -1 or -1 < open_index < close_index:
+                index, brace = open_index, '{'
+            else:
+                index, brace = close_index, '}'
+            if index == -1 or not input.startswith(brace, index + 1):
+                self._open, self._close = open_index, close_index
+                return index
+
+            end = index + 2
+            while input.startswith(brace, end):
+                end += 1
+            if brace == '{':
+                open_index = input.find('{', end)
+            else:
+                close_index = input.find('}', end)
+
+    def advance(self) -> None:
+        # the advance method of the current state is kept in _advance_state, the
+        # state only has to be checked when a brace ends the current segment
+        while not self._advance_state():
+            brace = self._brace
+            if brace == -1:
+                self.token = self.value = None
+                return
+
+            self.position = brace, brace + 1
+            if self.state == self.state_string:
+                if self.input[brace] == '}':
+                    raise XtendParseException(self, '{', '}')
                 self.state = self.state_xtend
-                return self.next()
-
-        if self.state == self.state_xtend:
-            if token in ['other', 'newline', 'indent']:
-                values = [value]
-                while self._peek()[0] in ['other', 'newline', 'indent']:
-                    _, value = self._next()
-                    values.append(value)
-                code_value = (''.join(values)).strip()
-                if code_value != '':
-                    return 'code', ''.join(values)
-                return self.next()
-
-            if token == 'keyword':
-                return token, value
-
-            if token == 'close':
-                self.state = 'string'
-                return self.next()
-
-        if token is None:
-            return None, None
+                self._advance_state = self._advance_xtend
+                self._segment(brace + 1)
+                self._keywords = self._find_keywords()
 
-        raise NotImplementedError()  # pragma: no cover
+            else:
+                if self.input[brace] == '{':
+                    raise XtendParseException(self, '}', '{')
+                self.state = self.state_string
+                self._advance_state = self._advance_string
+                self._segment(brace + 1)
+
+    def _advance_string(self) -> bool:
+        # the whole segment, including newlines and indentation, is one string
+        start, stop = self._start, self._stop
+        if start == stop:
+            return False
+        self.token, self.value = T_STRING, self.input[start:stop]
+        self.position = start, stop
+        self._start = stop
+        return True
+
+    def _advance_xtend(self) -> bool:
+        # xtend -> (keyword | code)*
+        input, start, stop = self.input, self._start, self._stop
+        keywords = self._keywords
+        end = keywords[-1][0] if keywords else stop
+        code = input[start:end]
+        if code and not code.isspace():
+            self.token, self.value = T_CODE, code
+            self.position = start, end
+            self._start = end
+            return True
+
+        if not keywords:
+            self._start = stop
+            return False
+
+        start, end, keyword = keywords.pop()
+        self.token, self.value = T_KEYWORD, keyword
+        self.position = start, end
+        self._start = end
+        return True
+
+    def _find_keywords(self) -> List[Tuple[int, int, str]]:
+        # the spans and values of all keywords in the current segment, in reverse
+        # order; the value is the string already taken from the match
+        keywords = []
+        for match in _find_words(self.input, self._start, self._stop):
+            word = match.group()
+            if word in KEYWORDS:
+                keywords.append((match.start(), match.end(), word))
+        keywords.reverse()
+        return keywords
 
     def end(self):
         if self.state == self.state_xtend:
             raise XtendParseException(self, '}')
 
 
-def scan(input):
+def scan(input) -> List[Tuple[str, str]]:
     scanner = Scanner(input)
     results = []
-    while True:
-        token, value = scanner.next()
-        if token is None:
-            break
-        results.append((token, value))
+    while scanner.token is not None:
+        results.append((scanner.token, scanner.value))
+        scanner.advance()
     scanner.end()
     return results
 
@@ -116,69 +179,94 @@ class XtendParseException(Exception):
         self.msg += f'at [{self.position[0]}:{self.position[1]}]'
         super().__init__(self.msg)
 
-    def readable_error_position(self, **kwargs):
-        result = ''
+    def readable_error_position(self, **kwargs) -> str:
+        # the input with a line of carets below the line that contains the error
+        input = self.scanner.input
         start, stop = self.position
-        lines = self.scanner.input.split('\n')
-        for line in lines:
-            result += line + '\n'
-            if start < len(line) + 1 and start >= 0:
-                for pos in range(0, stop):
-                    result += ' ' if pos < start else '^'
-                result += '\n'
-            start -= len(line) + 1
-            stop -= len(line) + 1
-        return result
+        line_start = input.rfind('\n', 0, start) + 1
+        line_end = input.find('\n', start)
+        if line_end == -1:
+            line_end = len(input)
+        carets = ' ' * (start - line_start) + '^' * (stop - start)
+        rest = input[line_end + 1:] + '\n' if line_end < len(input) else ''
+        return f'{input[:line_end]}\n{carets}\n{rest}'
 
 
+@dataclass(frozen=True)
 class Context():
-    remove: str = None
+    remove: Optional[str] = None
 
 
 @dataclass(frozen=True)
 class Node:
-    context: Context
+    __slots__ = ()
+    context: ClassVar[Context] = Context()
 
     def run(self, globals, locals) -> str:
         raise NotImplementedError()  # pragma: no cover
 
+    def compile(self, compiler: 'Compiler', out: str, locals: str) -> None:
+        # adds statements that append the output to the list named out and
+        # evaluate code with the locals dict named locals
+        raise NotImplementedError()  # pragma: no cover
+
 
 @dataclass(frozen=True)
 class StmtsNode(Node):
-    stmts: List[Node]
+    __slots__ = ('stmts',)
+    stmts: Tuple[Node, ...]
 
-    def run(self, *args) -> str:
-        return ''.join([stmt.run(*args) for stmt in self.stmts])
+    def run(self, globals, locals) -> str:
+        # str.join turns any iterable into a list first, a list comprehension
+        # is the cheapest way to provide one
+        return ''.join([stmt.run(globals, locals) for stmt in self.stmts])
+
+    def compile(self, compiler: 'Compiler', out: str, locals: str) -> None:
+        for stmt in self.stmts:
+            stmt.compile(compiler, out, locals)
 
 
 @dataclass(frozen=True)
 class IfNode(Node):
-    if_branches: List[Tuple[str, Node]]
-    else_branch: Optional[Node] = None
+    __slots__ = ('if_branches', 'else_branch')
+    if_branches: Tuple[Tuple[CodeType, Node], ...]
+    else_branch: Optional[Node]
 
-    def run(self, *args) -> str:
+    def run(self, globals, locals) -> str:
         for condition, stmt in self.if_branches:
-            if eval(condition, *args):
-                return stmt.run(*args)
+            if eval(condition, globals, locals):
+                return stmt.run(globals, locals)
         if self.else_branch:
-            return self.else_branch.run(*args)
+            return self.else_branch.run(globals, locals)
 
         return ''
 
+    def compile(self, compiler: 'Compiler', out: str, locals: str) -> None:
+        keyword = 'if'
+        for condition, stmt in self.if_branches:
+            compiler.line(f'{keyword} eval({compiler.constant(condition)}, _globals, {locals}):')
+            compiler.block(stmt, out, locals)
+            keyword = 'elif'
+        if self.else_branch:
+            compiler.line('else:')
+            compiler.block(self.else_branch, out, locals)
+
 
 @dataclass(frozen=True)
 class ForNode(Node):
+    __slots__ = ('var', 'list_expr', 'body', 'separator_expr')
     var: str
-    list_expr: str
+    list_expr: CodeType
     body: Node
-    separator_expr: Optional[str] = None
+    separator_expr: Optional[CodeType]
 
     def run(self, globals, locals) -> str:
-        new_locals = dict(**locals)
+        new_locals = dict(locals)
+        body_run, var = self.body.run, self.var
         results = []
         for item in eval(self.list_expr, globals, locals):
-            new_locals[self.var] = item
-            results.append(self.body.run(globals, new_locals))
+            new_locals[var] = item
+            results.append(body_run(globals, new_locals))
 
         if self.separator_expr:
             separator = eval(self.separator_expr, globals, locals)
@@ -186,167 +274,289 @@ class ForNode(Node):
             separator = ''
         return separator.join(results)
 
+    def compile(self, compiler: 'Compiler', out: str, locals: str) -> None:
+        new_locals = compiler.name('locals')
+        results = compiler.name('results')
+        item = compiler.name('item')
+        body_out = compiler.name('out')
+        compiler.line(f'{new_locals} = dict({locals})')
+        compiler.line(f'{results} = []')
+        compiler.line(f'for {item} in eval({compiler.constant(self.list_expr)}, _globals, {locals}):')
+        compiler.indent += 1
+        compiler.line(f'{new_locals}[{self.var!r}] = {item}')
+        compiler.line(f'{body_out} = []')
+        self.body.compile(compiler, body_out, new_locals)
+        compiler.line(f"{results}.append(''.join({body_out}))")
+        compiler.indent -= 1
+
+        if self.separator_expr:
+            separator = f'eval({compiler.constant(self.separator_expr)}, _globals, {locals})'
+        else:
+            separator = "''"
+        compiler.line(f'{out}.append({separator}.join({results}))')
+
 
 @dataclass(frozen=True)
 class ExprNode(Node):
-    expr: str
+    __slots__ = ('expr',)
+    expr: CodeType
+
+    def run(self, globals, locals) -> str:
+        return eval(self.expr, globals, locals)
 
-    def run(self, *args) -> str:
-        return eval(self.expr, *args)
+    def compile(self, compiler: 'Compiler', out: str, locals: str) -> None:
+        compiler.line(f'{out}.append(eval({compiler.constant(self.expr)}, _globals, {locals}))')
+
+
+_str_translation = str.maketrans({' ': '.', '\n': 'R\n'})
 
 
 @dataclass(frozen=True)
 class StrNode(Node):
+    __slots__ = ('value',)
     value: str
 
-    def run(self, *args) -> str:
-        return self.value.replace(' ', '.').replace('\n', 'R\n')
+    def run(self, globals, locals) -> str:
+        return self.value.translate(_str_translation)
+
+    def compile(self, compiler: 'Compiler', out: str, locals: str) -> None:
+        compiler.line(f'{out}.append({self.value.translate(_str_translation)!r})')
+
+
+@dataclass
+class _Frame:
+    # an IF or FOR statement whose END has not been parsed yet
+    __slots__ = ('keyword', 'outer', 'condition', 'if_branches', 'for_args')
+    keyword: str
+    outer: List[Node]
+    condition: Optional[CodeType]  # of the current IF/ELIF branch, None after ELSE
+    if_branches: List[Tuple[CodeType, Node]]
+    for_args: Optional[Tuple[str, CodeType, Optional[CodeType]]]
 
 
 class Parser():
-    def __init__(self, input: str):
+    '''
+    Parses without recursion. The statements of the innermost open block are
+    collected in stmts, the enclosing open IF/FOR statements are kept on a stack.
+    '''
+    __slots__ = ('scanner', 'max_depth', 'stack')
+
+    def __init__(self, input: str, max_depth: int = 200):
         self.scanner = Scanner(input)
-        self._lookahead: Tuple[str, str] = None
-        self.context = Context()
+        self.max_depth = max_depth
+        self.stack: List[_Frame] = []
 
     def fail(self, expected: Union[str, List[str]], got: str) -> NoReturn:
         raise XtendParseException(self.scanner, expected, got)
 
-    def _next(self) -> Tuple[str, str]:
-        if self._lookahead:
-            next_item = self._lookahead
-            self._lookahead = None
-            return next_item
-        return self.scanner.next()
-
-    def _peek(self) -> Tuple[str, str]:
-        if not self._lookahead:
-            self._lookahead = self._next()
-        return self._lookahead
-
     def parse_keyword(self, keyword: str) -> None:
-        token, value = self._next()
-        if token != 'keyword' or value != keyword:
-            self.fail(expected=keyword, got=token)
+        scanner = self.scanner
+        if scanner.token is not T_KEYWORD or scanner.value != keyword:
+            self.fail(expected=keyword, got=scanner.token)
+        scanner.advance()
 
     def parse_code(self) -> str:
-        token, value = self._next()
-        if token == 'code':
-            return value.strip()
-        self.fail(expected='code', got=token)
+        scanner = self.scanner
+        if scanner.token is not T_CODE:
+            self.fail(expected='code', got=scanner.token)
+        value = scanner.value
+        scanner.advance()
+        return value.strip()
+
+    def parse_expr(self) -> CodeType:
+        # expressions are compiled once here and not on every evaluation
+        scanner = self.scanner
+        if scanner.token is not T_CODE:
+            self.fail(expected='code', got=scanner.token)
+        expr = scanner.value.strip()
+        try:
+            code = compile(expr, '<xtend>', 'eval')
+        except SyntaxError:
+            self.fail(expected='python expression', got=expr)
+        scanner.advance()
+        return code
 
     def parse_string(self) -> str:
-        string_value = []
-        while True:
-            token, value = self._peek()
-            if token in ['string', 'indent', 'newline']:
-                self._next()
-                string_value.append(value)
-
-            else:
-                return ''.join(string_value)
+        scanner = self.scanner
+        if scanner.token is not T_STRING:
+            self.fail(expected='string', got=scanner.token)
+        value = scanner.value
+        scanner.advance()
+        return value
 
     def parse_xtend(self) -> StmtsNode:
-        stmts = self.parse_stmts()
-        token, value = self._next()
-        if token is not None:
-            self.fail('end', value if token == 'keyword' else token)
-        self.scanner.end()
-        return stmts
-
-    def parse_stmts(self, allow_empty=False) -> StmtsNode:
+        # xtend -> stmt+, stmt -> string | expr | if | for
+        scanner = self.scanner
+        predict = _predict.get
         stmts: List[Node] = []
         while True:
-            token, value = self._peek()
-            if token == 'keyword' and value in ['ELIF', 'ELSE', 'END']:
-                break
-            if token is None:
-                break
-            stmts.append(self.parse_stmt())
-
-        if not allow_empty:
-            if len(stmts) == 0:
-                self.fail(expected=['string', 'code'], got=token)
-        return StmtsNode(context=self.context, stmts=stmts)
-
-    def parse_stmt(self) -> Node:
-        # stmt -> string | if | for | expr
-        token, value = self._peek()
-        if token == 'keyword':
-            if value == 'IF':
-                return self.parse_if()
-
-            if value == 'FOR':
-                return self.parse_for()
-
-        if token in ['string', 'indent', 'newline']:
-            return StrNode(context=self.context, value=self.parse_string())
-
-        if token == 'code':
-            return self.parse_expr()
-
-        raise NotImplementedError()  # pragma: no cover
-
-    def parse_expr(self) -> ExprNode:
-        return ExprNode(context=self.context, expr=self.parse_code())
-
-    def parse_if(self) -> IfNode:
-        # if -> IF CODE stmt (ELIF CODE stmt)* (ELSE stmt)? END
-        if_branches: List[Tuple[str, Node]] = []
-        self.parse_keyword('IF')
-        if_branches.append((self.parse_code(), self.parse_stmts()))
-        else_branch: Node = None
-
-        while True:
-            token, value = self._peek()
-            if token == 'keyword':
-                if value == 'ELIF':
-                    self._next()
-                    if_branches.append((self.parse_code(), self.parse_stmts()))
-                    continue
-
-                if value == 'ELSE':
-                    self._next()
-                    else_branch = self.parse_stmts()
-                    break
-
-                if value == 'END':
+            # LL(1): the current token alone determines the production
+            token = scanner.token
+            parse_stmt = predict(scanner.value if token is T_KEYWORD else token)
+            if parse_stmt is None:
+                if token is None:
                     break
+                self.fail(expected=self.expected_stmt(), got=scanner.value)
+            stmts = parse_stmt(self, stmts)
+
+        scanner.end()
+        if len(self.stack) > 0:
+            self.fail(expected='END', got=token)
+        return self.block(stmts)
+
+    def expected_stmt(self) -> List[str]:
+        # the tokens that can start the next statement in the current context
+        expected = ['string', 'code', 'IF', 'FOR']
+        if self.stack:
+            frame = self.stack[-1]
+            if frame.keyword == 'IF' and frame.condition is not None:
+                expected += ['ELIF', 'ELSE']
+            expected.append('END')
+        return expected
+
+    def block(self, stmts: List[Node]) -> StmtsNode:
+        if len(stmts) == 0:
+            self.fail(expected=['string', 'code'], got=self.scanner.value)
+        return StmtsNode(stmts=tuple(stmts))
+
+    def open_block(self, frame: _Frame) -> List[Node]:
+        if len(self.stack) >= self.max_depth:
+            self.fail(expected=f'at most {self.max_depth} nested statements', got=frame.keyword)
+        self.stack.append(frame)
+        return []
+
+    def parse_string_stmt(self, stmts: List[Node]) -> List[Node]:
+        stmts.append(StrNode(value=self.parse_string()))
+        return stmts
 
-                raise NotImplementedError()  # pragma: no cover
-
-        self.parse_keyword('END')
-
-        return IfNode(
-            context=self.context, if_branches=if_branches, else_branch=else_branch)
+    def parse_expr_stmt(self, stmts: List[Node]) -> List[Node]:
+        stmts.append(ExprNode(expr=self.parse_expr()))
+        return stmts
 
-    def parse_for(self) -> ForNode:
-        # for -> FOR code IN code (SEPARATOR code)? stmt END
+    def parse_if(self, stmts: List[Node]) -> List[Node]:
+        # if -> IF CODE stmt+ (ELIF CODE stmt+)* (ELSE stmt+)? END
+        self.parse_keyword('IF')
+        return self.open_block(_Frame('IF', stmts, self.parse_expr(), [], None))
+
+    def parse_else(self, stmts: List[Node]) -> List[Node]:
+        # ELIF and ELSE close the current branch of the innermost IF
+        keyword = self.scanner.value
+        frame = self.stack[-1] if len(self.stack) > 0 else None
+        if frame is None or frame.keyword != 'IF' or frame.condition is None:
+            self.fail(expected='END' if frame else ['IF', 'FOR'], got=keyword)
+        frame.if_branches.append((frame.condition, self.block(stmts)))
+        self.scanner.advance()
+        frame.condition = self.parse_expr() if keyword == 'ELIF' else None
+        return []
+
+    def parse_for(self, stmts: List[Node]) -> List[Node]:
+        # for -> FOR code IN code (SEPARATOR code)? stmt+ END
         self.parse_keyword('FOR')
         var = self.parse_code()
         self.parse_keyword('IN')
-        list_expr = self.parse_code()
-        token, value = self._peek()
-        if token == 'keyword' and value == 'SEPARATOR':
-            self.parse_keyword('SEPARATOR')
-            separator_expr = self.parse_code()
+        list_expr = self.parse_expr()
+        if self.scanner.token is T_KEYWORD and self.scanner.value == 'SEPARATOR':
+            self.scanner.advance()
+            separator_expr = self.parse_expr()
         else:
             separator_expr = None
-        body = self.parse_stmts()
-        self.parse_keyword('END')
-
-        return ForNode(
-            context=self.context, var=var, list_expr=list_expr, body=body,
-            separator_expr=separator_expr)
-
-
+        return self.open_block(_Frame('FOR', stmts, None, [], (var, list_expr, separator_expr)))
+
+    def parse_end(self, stmts: List[Node]) -> List[Node]:
+        if len(self.stack) == 0:
+            self.fail(expected=['IF', 'FOR'], got='END')
+        body = self.block(stmts)
+        self.scanner.advance()
+        frame = self.stack.pop()
+        node: Node
+        if frame.keyword == 'FOR':
+            var, list_expr, separator_expr = frame.for_args
+            node = ForNode(
+                var=var, list_expr=list_expr, body=body, separator_expr=separator_expr)
+        else:
+            else_branch: Optional[Node] = None
+            if frame.condition is None:
+                else_branch = body
+            else:
+                frame.if_branches.append((frame.condition, body))
+            node = IfNode(if_branches=tuple(frame.if_branches), else_branch=else_branch)
+
+        frame.outer.append(node)
+        return frame.outer
+
+
+# The parse methods for each token type, or keyword for keyword tokens. Each method
+# gets and returns the statement list of the innermost open block.
+_predict = {
+    T_STRING: Parser.parse_string_stmt,
+    T_CODE: Parser.parse_expr_stmt,
+    'IF': Parser.parse_if,
+    'ELIF': Parser.parse_else,
+    'ELSE': Parser.parse_else,
+    'FOR': Parser.parse_for,
+    'END': Parser.parse_end
+}
+
+
+class Compiler():
+    '''
+    Generates and compiles the source of a python function render(globals, locals)
+    that produces the same output as running the given template node.
+    '''
+    def __init__(self) -> None:
+        self.lines: List[str] = []
+        self.constants: Dict[str, Any] = {}
+        self.indent = 1
+        self._names = 0
+
+    def name(self, prefix: str) -> str:
+        self._names += 1
+        return f'_{prefix}{self._names}'
+
+    def constant(self, value: Any) -> str:
+        # the name under which the given value is available to the generated code
+        name = self.name('const')
+        self.constants[name] = value
+        return name
+
+    def line(self, line: str) -> None:
+        self.lines.append('    ' * self.indent + line)
+
+    def block(self, node: Node, out: str, locals: str) -> None:
+        self.indent += 1
+        node.compile(self, out, locals)
+        self.indent -= 1
+
+    def compile(self, node: Node) -> Callable[[dict, dict], str]:
+        self.line('_out = []')
+        node.compile(self, '_out', '_locals')
+        self.line("return ''.join(_out)")
+        source = 'def render(_globals, _locals):\n' + '\n'.join(self.lines) + '\n'
+        namespace = dict(self.constants)
+        exec(compile(source, '<xtend>', 'exec'), namespace)  # pylint: disable=exec-used
+        return namespace['render']
+
+
+@functools.lru_cache(maxsize=256)
 def parse(input: str) -> StmtsNode:
+    # The result is shared between all callers with the same input; nodes must
+    # not be modified.
     return Parser(input).parse_xtend()
 
 
+@functools.lru_cache(maxsize=256)
+def compile_template(input: str) -> Callable[[dict, dict], str]:
+    node = parse(input)
+    try:
+        return Compiler().compile(node)
+    except (SyntaxError, RecursionError):
+        # deeply nested templates exceed the limits of the python compiler
+        return node.run
+
+
 def xtend(input: str, globals: dict = None, locals: dict = None) -> str:
     if globals is None:
         globals = inspect.currentframe().f_back.f_globals
     if locals is None:
         locals = inspect.currentframe().f_back.f_locals
-    return parse(input).run(globals, locals)
+    return compile_template(input)(globals, locals)